@@ -1,9 +1,47 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from llm import llm
-import logging
+from llm import llm, http_async_client, warmup_llm, LLM_WARMUP
+from log import logger
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator
 
+import orjson
 
-logger = logging.getLogger("ws-chat")
+
+# Streaming: coalesce tokens into one frame every N chars or M seconds
+STREAM_FLUSH_CHARS = 64
+STREAM_FLUSH_INTERVAL = 0.025
+
+
+async def send_json_fast(websocket: WebSocket, obj: Any) -> None:
+    """Send JSON via orjson (sent as a binary frame; clients decode it the same way)."""
+    await websocket.send_bytes(orjson.dumps(obj))
+
+
+async def iter_frames(websocket: WebSocket) -> AsyncIterator[str | bytes]:
+    """Yield raw text/binary frames until the client disconnects (like WebSocket.iter_bytes, for either frame type)."""
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            return
+
+        data = message.get("bytes")
+        yield data if data is not None else message["text"]
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Startup/shutdown hooks."""
+    # Warm up Azure connections (best effort; never blocks startup for long)
+    if LLM_WARMUP:
+        try:
+            async with asyncio.timeout(15):
+                await warmup_llm()
+        except Exception:
+            logger.warning("LLM warmup failed", exc_info=True)
+
+    yield
+    await http_async_client.aclose()
 
 
 # Create FastAPI APP:
@@ -13,6 +51,7 @@ app = FastAPI(
     version="1.0.0",
     docs_url="/swagger",
     redoc_url="/redoc",
+    lifespan=lifespan,
 )
 
 
@@ -25,9 +64,9 @@ async def ws_chat(websocket: WebSocket):
     logger.info("WebSocket connected")
 
     try:
-        while True:
+        async for raw in iter_frames(websocket):
             # 1) Receive JSON from Postman
-            data = await websocket.receive_json()
+            data = orjson.loads(raw)
             user_text = data.get("message", "")
 
             if not isinstance(user_text, str) or not user_text.strip():
@@ -46,7 +85,10 @@ async def ws_chat(websocket: WebSocket):
             # 4) Send string back
             await websocket.send_text(reply_text)
 
+        logger.info("WebSocket disconnected by client")
+
     except WebSocketDisconnect:
+        # A send after the client has gone
         logger.info("WebSocket disconnected by client")
 
     except Exception as e:
@@ -66,49 +108,90 @@ async def ws_chat(websocket: WebSocket):
     logger.info("WebSocket connected")
 
     try:
-        while True:
+        async for raw in iter_frames(websocket):
             # 1) Receive JSON from Postman
-            data = await websocket.receive_json()
+            data = orjson.loads(raw)
             user_text = data.get("message", "")
 
             if not isinstance(user_text, str) or not user_text.strip():
-                await websocket.send_json({
+                await send_json_fast(websocket, {
                     "type": "error",
                     "message": "Invalid payload. Send: {'message': '<non-empty string>'}"
                 })
                 continue
 
             # 2) Tell client streaming is starting
-            await websocket.send_json({"type": "start"})
+            await send_json_fast(websocket, {"type": "start"})
 
             # 3) Stream tokens/chunks from LLM
-            full_text = ""
-            async for chunk in llm.astream(user_text):
-                # chunk can be str OR AIMessageChunk OR other chunk type
-                if hasattr(chunk, "content"):
-                    token = chunk.content
-                else:
-                    token = str(chunk)
-
-                # Some providers send empty/None chunks
-                if not token:
-                    continue
-
-                full_text += token
-
-                # Send incremental chunk to client
-                await websocket.send_json({
+            parts: list[str] = []
+            buf: list[str] = []
+            buf_len = 0
+            loop = asyncio.get_running_loop()
+            last_flush = loop.time()
+            stream = aiter(llm.astream(user_text))
+            next_chunk = None
+            try:
+                while True:
+                    # While tokens are buffered, wait for the next one only until the flush deadline.
+                    # Shielded: hitting the deadline must not cancel the LLM stream itself.
+                    if next_chunk is None:
+                        next_chunk = asyncio.ensure_future(anext(stream, None))
+                    try:
+                        async with asyncio.timeout_at(last_flush + STREAM_FLUSH_INTERVAL if buf else None):
+                            chunk = await asyncio.shield(next_chunk)
+                        next_chunk = None
+                    except TimeoutError:
+                        chunk = ""  # deadline reached: flush below
+                    if chunk is None:
+                        break
+
+                    # chunk can be str OR AIMessageChunk OR other chunk type
+                    if hasattr(chunk, "content"):
+                        token = chunk.content
+                    else:
+                        token = str(chunk)
+
+                    # Some providers send empty/None chunks
+                    if token:
+                        parts.append(token)
+                        buf.append(token)
+                        buf_len += len(token)
+
+                    # Send buffered tokens as one incremental chunk (first token immediately)
+                    if buf and (len(parts) == 1 or buf_len >= STREAM_FLUSH_CHARS or loop.time() - last_flush >= STREAM_FLUSH_INTERVAL):
+                        await send_json_fast(websocket, {
+                            "type": "chunk",
+                            "value": "".join(buf)
+                        })
+                        buf.clear()
+                        buf_len = 0
+                        last_flush = loop.time()
+            finally:
+                # Client gone / error mid-stream: stop the pending read and close the LLM stream
+                if next_chunk is not None:
+                    next_chunk.cancel()
+                    await asyncio.gather(next_chunk, return_exceptions=True)
+                if hasattr(stream, "aclose"):
+                    await stream.aclose()
+
+            # Flush whatever is left in the buffer
+            if buf:
+                await send_json_fast(websocket, {
                     "type": "chunk",
-                    "value": token
+                    "value": "".join(buf)
                 })
 
             # 4) Tell client streaming finished (optionally include full text)
-            await websocket.send_json({
+            await send_json_fast(websocket, {
                 "type": "end",
-                "full": full_text
+                "full": "".join(parts)
             })
 
+        logger.info("WebSocket disconnected by client")
+
     except WebSocketDisconnect:
+        # A send after the client has gone
         logger.info("WebSocket disconnected by client")
 
     except Exception as e:
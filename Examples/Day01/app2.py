@@ -1,16 +1,53 @@
 import asyncio
+import itertools
 import logging
-import uuid
-from typing import Any, Optional
+import os
+import secrets
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Optional
 
+import orjson
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, status
-from pydantic import BaseModel, ValidationError, Field
+from pydantic import BaseModel, TypeAdapter, ValidationError, Field
 
-from llm import llm  # your LangChain (or other) LLM object
+from llm import llm, http_async_client, warmup_llm, LLM_WARMUP  # your LangChain (or other) LLM object
+from cache import response_cache  # None unless CACHE_ENABLED
+from log import logger  # shared, queue-based "ws-chat" logger
 
 
-# Define the Logger:
-logger = logging.getLogger("ws-chat")
+# Short connection/request ids (random start, so ids differ across workers/restarts)
+_CONN_COUNTER = itertools.count(secrets.randbits(32))
+_REQ_COUNTER = itertools.count(secrets.randbits(32))
+
+# Global cap on concurrent LLM calls (across all connections)
+LLM_SEM = asyncio.Semaphore(int(os.getenv("LLM_MAX_CONCURRENCY", "32")))
+
+# Streaming: coalesce tokens into one frame every N chars or M seconds
+STREAM_FLUSH_CHARS = 64
+STREAM_FLUSH_INTERVAL = 0.025
+STREAM_QUEUE_SIZE = 64
+
+# Global cap on concurrent streaming sessions; requests over the limit get BUSY + close 1013
+STREAM_SEM = asyncio.Semaphore(int(os.getenv("MAX_STREAMS", "64")))
+# Max seconds an admitted stream waits for a free LLM slot before getting BUSY + close 1013
+LLM_SLOT_TIMEOUT = float(os.getenv("LLM_SLOT_TIMEOUT", "5"))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Startup/shutdown hooks."""
+    # Warm up Azure connections (best effort; never blocks startup for long)
+    if LLM_WARMUP:
+        try:
+            async with asyncio.timeout(15):
+                await warmup_llm()
+                if response_cache is not None:
+                    await response_cache.warmup()
+        except Exception:
+            logger.warning("LLM warmup failed", exc_info=True)
+
+    yield
+    await http_async_client.aclose()
 
 
 # Define the FastAPI APP:
@@ -20,6 +57,7 @@ app = FastAPI(
     version="1.0.0",
     docs_url="/swagger",
     redoc_url="/redoc",
+    lifespan=lifespan,
 )
 
 
@@ -27,19 +65,57 @@ app = FastAPI(
 # 1) Request/Response Schemas
 # ---------------------------
 
+MAX_MESSAGE_LENGTH = 8000
+
+
 class ChatRequest(BaseModel):
-    message: str = Field(..., min_length=1, max_length=8000)
+    message: str = Field(..., min_length=1, max_length=MAX_MESSAGE_LENGTH)
+
+
+# Built once: caches the pydantic-core validator for ChatRequest
+_REQ_ADAPTER = TypeAdapter(ChatRequest)
+
+
+def validate_chat_request(data: Any) -> ChatRequest:
+    """Validate client JSON; the common valid case skips Pydantic validation entirely."""
+    if isinstance(data, dict) and isinstance(m := data.get("message"), str) and 1 <= len(m) <= MAX_MESSAGE_LENGTH:
+        return ChatRequest.model_construct(message=m)
+    return _REQ_ADAPTER.validate_python(data)  # raises ValidationError
+
+
+# Text extractor per result/chunk class (almost always AIMessageChunk when streaming)
+_EXTRACTORS: dict[type, Callable[[Any], str]] = {}
+
+
+def _make_extractor(sample: Any) -> Callable[[Any], str]:
+    # Decided on an instance: Pydantic models (LangChain messages) don't expose fields on the class.
+    if hasattr(sample, "content"):
+        return lambda x: x.content or ""
+    return lambda x: "" if x is None else str(x)
 
 
 def to_text(result: Any) -> str:
     """Convert LLM result / chunk to plain text safely."""
-    if result is None:
-        return ""
-    
-    if hasattr(result, "content"):
-        return result.content or ""
-    
-    return str(result)
+    fn = _EXTRACTORS.get(type(result))
+    if fn is None:
+        fn = _EXTRACTORS.setdefault(type(result), _make_extractor(result))
+    return fn(result)
+
+
+async def send_json_fast(websocket: WebSocket, obj: Any) -> None:
+    """Send JSON via orjson (sent as a binary frame; clients decode it the same way)."""
+    await websocket.send_bytes(orjson.dumps(obj))
+
+
+async def iter_frames(websocket: WebSocket) -> AsyncIterator[str | bytes]:
+    """Yield raw text/binary frames until the client disconnects (like WebSocket.iter_bytes, for either frame type)."""
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            return
+
+        data = message.get("bytes")
+        yield data if data is not None else message["text"]
 
 
 async def safe_close(websocket: WebSocket, code: int = status.WS_1000_NORMAL_CLOSURE) -> None:
@@ -56,24 +132,20 @@ async def safe_close(websocket: WebSocket, code: int = status.WS_1000_NORMAL_CLO
 # 2) Common handler utilities
 # ---------------------------
 
-async def receive_chat_request(websocket: WebSocket) -> Optional[ChatRequest]:
+async def parse_chat_request(websocket: WebSocket, raw: str | bytes) -> Optional[ChatRequest]:
     """
-    Receives and validates client JSON.
+    Parses and validates one client frame.
     Returns ChatRequest or None if invalid (and sends error to client).
     """
     try:
-        data = await websocket.receive_json()
-        req = ChatRequest.model_validate(data)  # Pydantic v2
-        logger.info("Received request: %s", req)
+        req = validate_chat_request(orjson.loads(raw))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received request: %d chars", len(req.message))
 
         return req
-    
-    except WebSocketDisconnect:
-        logger.info("WebSocket disconnected.")
-        raise
 
     except ValidationError as ve:
-        await websocket.send_json({
+        await send_json_fast(websocket, {
             "type": "error",
             "code": "INVALID_PAYLOAD",
             "detail": ve.errors(),
@@ -83,7 +155,7 @@ async def receive_chat_request(websocket: WebSocket) -> Optional[ChatRequest]:
         return None
     
     except Exception as e:
-        await websocket.send_json({
+        await send_json_fast(websocket, {
             "type": "error",
             "code": "BAD_REQUEST",
             "detail": str(e),
@@ -99,52 +171,58 @@ async def receive_chat_request(websocket: WebSocket) -> Optional[ChatRequest]:
 @app.websocket("/ws/chat")
 async def ws_chat_non_stream(websocket: WebSocket):
     await websocket.accept()
-    conn_id = str(uuid.uuid4())[:8]
+    conn_id = f"{next(_CONN_COUNTER) & 0xFFFFFFFF:08x}"
     logger.info("WS connected /ws/chat conn_id=%s", conn_id)
 
-    # Basic per-connection rate limit
-    # (Allows 1 request at a time; prevents flooding)
-    lock = asyncio.Lock()
-
     try:
-        while True:
-            # 1) Receive and validate request
-            req = await receive_chat_request(websocket)
+        async for raw in iter_frames(websocket):
+            # 1) Validate request
+            req = await parse_chat_request(websocket, raw)
             if req is None:
                 continue
 
-            async with lock:
-                request_id = str(uuid.uuid4())[:8]
-                try:
-                    # Timeout on LLM call (avoid hanging)
-                    result = await asyncio.wait_for(llm.ainvoke(req.message), timeout=60)
-
+            request_id = f"{next(_REQ_COUNTER) & 0xFFFFFFFF:08x}"
+            try:
+                # Serve from cache if possible (skips the LLM round-trip)
+                lookup = await response_cache.lookup(req.message) if response_cache else None
+                if lookup is not None and lookup.value is not None:
+                    reply_text = lookup.value
+
+                else:
+                    # Timeout on LLM call (avoid hanging); LLM_SEM caps concurrent calls
+                    async with LLM_SEM, asyncio.timeout(60):
+                        result = await llm.ainvoke(req.message)
                     reply_text = to_text(result)
+                    if lookup is not None:
+                        await response_cache.store(lookup, reply_text)
+
+                await send_json_fast(websocket, {
+                    "type": "response",
+                    "request_id": request_id,
+                    "value": reply_text
+                })
+
+            except asyncio.TimeoutError:
+                await send_json_fast(websocket, {
+                    "type": "error",
+                    "code": "LLM_TIMEOUT",
+                    "request_id": request_id,
+                    "detail": "LLM call exceeded 60 seconds."
+                })
+
+            except Exception as e:
+                logger.exception("LLM error conn_id=%s request_id=%s", conn_id, request_id)
+                await send_json_fast(websocket, {
+                    "type": "error",
+                    "code": "LLM_ERROR",
+                    "request_id": request_id,
+                    "detail": str(e)
+                })
 
-                    await websocket.send_json({
-                        "type": "response",
-                        "request_id": request_id,
-                        "value": reply_text
-                    })
-
-                except asyncio.TimeoutError:
-                    await websocket.send_json({
-                        "type": "error",
-                        "code": "LLM_TIMEOUT",
-                        "request_id": request_id,
-                        "detail": "LLM call exceeded 60 seconds."
-                    })
-
-                except Exception as e:
-                    logger.exception("LLM error conn_id=%s request_id=%s", conn_id, request_id)
-                    await websocket.send_json({
-                        "type": "error",
-                        "code": "LLM_ERROR",
-                        "request_id": request_id,
-                        "detail": str(e)
-                    })
+        logger.info("WS disconnected /ws/chat conn_id=%s", conn_id)
 
     except WebSocketDisconnect:
+        # A send after the client has gone
         logger.info("WS disconnected /ws/chat conn_id=%s", conn_id)
 
     except Exception:
@@ -162,78 +240,156 @@ async def ws_chat_non_stream(websocket: WebSocket):
 @app.websocket("/ws/chat2")
 async def ws_chat_stream(websocket: WebSocket):
     await websocket.accept()
-    conn_id = str(uuid.uuid4())[:8]
+    conn_id = f"{next(_CONN_COUNTER) & 0xFFFFFFFF:08x}"
     logger.info("WS connected /ws/chat2 conn_id=%s", conn_id)
 
-    lock = asyncio.Lock()  # 1 generation at a time per connection
+    close_code = status.WS_1000_NORMAL_CLOSURE
 
     try:
-        while True:
-            req = await receive_chat_request(websocket)
+        async for raw in iter_frames(websocket):
+            req = await parse_chat_request(websocket, raw)
             if req is None:
                 continue
 
-            async with lock:
-                request_id = str(uuid.uuid4())[:8]
-                await websocket.send_json({"type": "start", "request_id": request_id})
-
-                full_text = ""
-
+            # Admission control: no free stream slot -> tell client to back off
+            if STREAM_SEM.locked():
+                await send_json_fast(websocket, {
+                    "type": "error",
+                    "code": "BUSY",
+                    "detail": "Too many concurrent streams. Try again later."
+                })
+                close_code = status.WS_1013_TRY_AGAIN_LATER
+                break
+
+            # Holds one stream slot and one LLM slot for the whole generation
+            async with STREAM_SEM:
+                # Bounded wait for an LLM slot (shared with /ws/chat): none free in time -> BUSY
                 try:
-                    # Optional overall timeout for streaming session
-                    async def stream_tokens():
-                        nonlocal full_text
-                        async for chunk in llm.astream(req.message):
-                            token = to_text(chunk)
-                            if not token:
-                                continue
-
-                            full_text += token
-
-                            # If client is gone, send_json will throw
-                            await websocket.send_json({
-                                "type": "chunk",
-                                "request_id": request_id,
-                                "value": token
-                            })
-
-                    await asyncio.wait_for(stream_tokens(), timeout=120)
-
-                    await websocket.send_json({
-                        "type": "end",
-                        "request_id": request_id,
-                        "full": full_text
-                    })
-
-                except asyncio.TimeoutError:
-                    await websocket.send_json({
+                    async with asyncio.timeout(LLM_SLOT_TIMEOUT):
+                        await LLM_SEM.acquire()
+                except TimeoutError:
+                    await send_json_fast(websocket, {
                         "type": "error",
-                        "code": "STREAM_TIMEOUT",
-                        "request_id": request_id,
-                        "detail": "Streaming exceeded 120 seconds."
+                        "code": "BUSY",
+                        "detail": "Too many concurrent streams. Try again later."
                     })
+                    close_code = status.WS_1013_TRY_AGAIN_LATER
+                    break
 
-                except WebSocketDisconnect:
-                    raise  # handled by outer except
+                try:
+                    request_id = f"{next(_REQ_COUNTER) & 0xFFFFFFFF:08x}"
+                    await send_json_fast(websocket, {"type": "start", "request_id": request_id})
+
+                    parts: list[str] = []
+                    buf: list[str] = []
+                    buf_len = 0
+                    loop = asyncio.get_running_loop()
+                    last_flush = loop.time()
+
+                    # LLM decode runs as its own task, feeding a bounded queue, so a slow
+                    # client doesn't stall token generation (up to STREAM_QUEUE_SIZE tokens).
+                    tokens: asyncio.Queue[Optional[str]] = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+
+                    async def produce() -> None:
+                        try:
+                            async for chunk in llm.astream(req.message):
+                                token = to_text(chunk)
+                                if token:  # some providers send empty/None chunks
+                                    await tokens.put(token)
+                        except Exception:
+                            await tokens.put(None)  # wake the consumer; error re-raised via `await producer`
+                            raise
+                        await tokens.put(None)
 
-                except Exception as e:
-                    logger.exception("Streaming error conn_id=%s request_id=%s", conn_id, request_id)
-                    # Best effort error message (client may already be gone)
                     try:
-                        await websocket.send_json({
+                        # Optional overall timeout for streaming session
+                        async with asyncio.timeout(120):
+                            producer = asyncio.create_task(produce())
+                            try:
+                                while True:
+                                    # While tokens are buffered, wait for the next one only until the flush deadline
+                                    try:
+                                        async with asyncio.timeout_at(last_flush + STREAM_FLUSH_INTERVAL if buf else None):
+                                            token = await tokens.get()
+                                    except TimeoutError:
+                                        token = ""  # deadline reached: flush below
+                                    if token is None:
+                                        break
+
+                                    if token:
+                                        parts.append(token)
+                                        buf.append(token)
+                                        buf_len += len(token)
+
+                                    # Send buffered tokens as one incremental chunk
+                                    # (if client is gone, the send will throw)
+                                    # First token goes out immediately (time to first token)
+                                    if buf and (len(parts) == 1 or buf_len >= STREAM_FLUSH_CHARS or loop.time() - last_flush >= STREAM_FLUSH_INTERVAL):
+                                        await send_json_fast(websocket, {
+                                            "type": "chunk",
+                                            "request_id": request_id,
+                                            "value": "".join(buf)
+                                        })
+                                        buf.clear()
+                                        buf_len = 0
+                                        last_flush = loop.time()
+
+                                await producer  # re-raises LLM errors
+                            finally:
+                                # Wait for the producer to unwind (closes the astream/HTTP stream)
+                                # before the semaphores are released.
+                                producer.cancel()
+                                await asyncio.gather(producer, return_exceptions=True)
+
+                            if buf:
+                                await send_json_fast(websocket, {
+                                    "type": "chunk",
+                                    "request_id": request_id,
+                                    "value": "".join(buf)
+                                })
+
+                        await send_json_fast(websocket, {
+                            "type": "end",
+                            "request_id": request_id,
+                            "full": "".join(parts)
+                        })
+
+                    except asyncio.TimeoutError:
+                        await send_json_fast(websocket, {
                             "type": "error",
-                            "code": "STREAM_ERROR",
+                            "code": "STREAM_TIMEOUT",
                             "request_id": request_id,
-                            "detail": str(e)
+                            "detail": "Streaming exceeded 120 seconds."
                         })
-                    except Exception:
-                        pass
+
+                    except WebSocketDisconnect:
+                        raise  # handled by outer except
+
+                    except Exception as e:
+                        logger.exception("Streaming error conn_id=%s request_id=%s", conn_id, request_id)
+                        # Best effort error message (client may already be gone)
+                        try:
+                            await send_json_fast(websocket, {
+                                "type": "error",
+                                "code": "STREAM_ERROR",
+                                "request_id": request_id,
+                                "detail": str(e)
+                            })
+                        except Exception:
+                            pass
+                finally:
+                    LLM_SEM.release()
+
+        else:
+            # Loop ended without a break: client disconnected
+            logger.info("WS disconnected /ws/chat2 conn_id=%s", conn_id)
 
     except WebSocketDisconnect:
+        # A send after the client has gone
         logger.info("WS disconnected /ws/chat2 conn_id=%s", conn_id)
 
     except Exception:
         logger.exception("WS fatal error /ws/chat2 conn_id=%s", conn_id)
 
     finally:
-        await safe_close(websocket, code=status.WS_1000_NORMAL_CLOSURE)
+        await safe_close(websocket, code=close_code)
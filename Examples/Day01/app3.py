@@ -1,14 +1,83 @@
 import asyncio
-import logging
-import uuid
-from typing import Any, Optional
+import itertools
+import os
+import secrets
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Optional
 
+import orjson
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, status
-from pydantic import BaseModel, ValidationError, Field
+from pydantic import BaseModel, TypeAdapter, ValidationError, Field
+
+from llm import llm, http_async_client, warmup_llm, LLM_WARMUP  # your LangChain (or other) LLM object
+from cache import response_cache  # None unless CACHE_ENABLED
+from log import logger  # shared, queue-based "ws-chat" logger
+
+
+# Short connection/request ids (random start, so ids differ across workers/restarts)
+_CONN_COUNTER = itertools.count(secrets.randbits(32))
+_REQ_COUNTER = itertools.count(secrets.randbits(32))
+
+# Global cap on concurrent LLM calls (across all connections)
+LLM_SEM = asyncio.Semaphore(int(os.getenv("LLM_MAX_CONCURRENCY", "32")))
+
+# Streaming: coalesce tokens into one frame every N chars or M seconds
+STREAM_FLUSH_CHARS = 64
+STREAM_FLUSH_INTERVAL = 0.025
+STREAM_QUEUE_SIZE = 64
+
+# Global cap on concurrent streaming sessions; requests over the limit get BUSY + close 1013
+STREAM_SEM = asyncio.Semaphore(int(os.getenv("MAX_STREAMS", "64")))
+# Max seconds an admitted stream waits for a free LLM slot before getting BUSY + close 1013
+LLM_SLOT_TIMEOUT = float(os.getenv("LLM_SLOT_TIMEOUT", "5"))
+
+# Pre-serialized error frames (sent as-is with websocket.send_bytes)
+ERR_TOO_BIG = orjson.dumps({
+    "type": "error",
+    "code": "MESSAGE_TOO_BIG",
+    "detail": "Message exceeds max length."
+})
+ERR_BUSY = orjson.dumps({
+    "type": "error",
+    "code": "BUSY",
+    "detail": "Too many concurrent streams. Try again later."
+})
+ERR_TOO_BIG_STREAM = orjson.dumps({
+    "type": "error",
+    "status": "MESSAGE_TOO_BIG",
+    "status_code": status.WS_1009_MESSAGE_TOO_BIG,
+    "detail": "Message exceeds max length."
+})
+
+# INVALID_PAYLOAD frames as (prefix, suffix) around orjson.dumps(errors).
+# VERBOSE (with example/status_code) goes out on a connection's first error, TERSE after that.
+_EXAMPLE_SUFFIX = b',"example":{"message":"Hi"}}'
+ERR_INVALID_VERBOSE = (b'{"type":"error","code":"INVALID_PAYLOAD","detail":', _EXAMPLE_SUFFIX)
+ERR_INVALID_TERSE = (b'{"type":"error","code":"INVALID_PAYLOAD","detail":', b'}')
+ERR_INVALID_STREAM_VERBOSE = (
+    b'{"type":"error","status":"INVALID_PAYLOAD","status_code":'
+    + str(status.HTTP_422_UNPROCESSABLE_ENTITY).encode()
+    + b',"detail":',
+    _EXAMPLE_SUFFIX
+)
+ERR_INVALID_STREAM_TERSE = (b'{"type":"error","status":"INVALID_PAYLOAD","detail":', b'}')
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Startup/shutdown hooks."""
+    # Warm up Azure connections (best effort; never blocks startup for long)
+    if LLM_WARMUP:
+        try:
+            async with asyncio.timeout(15):
+                await warmup_llm()
+                if response_cache is not None:
+                    await response_cache.warmup()
+        except Exception:
+            logger.warning("LLM warmup failed", exc_info=True)
 
-from llm import llm  # your LangChain (or other) LLM object
+    yield
+    await http_async_client.aclose()
 
-logger = logging.getLogger("ws-chat")
 
 app = FastAPI(
     title="Hirect",
@@ -16,26 +85,67 @@ app = FastAPI(
     version="1.0.0",
     docs_url="/swagger",
     redoc_url="/redoc",
+    lifespan=lifespan,
 )
 
 
 # ---------------------------
 # 1) Request Schema
 # ---------------------------
+MAX_MESSAGE_LENGTH = 8000
+
+
 class ChatRequest(BaseModel):
-    message: str = Field(..., min_length=1, max_length=8000)
+    message: str = Field(..., min_length=1, max_length=MAX_MESSAGE_LENGTH)
+
+
+# Built once: caches the pydantic-core validator for ChatRequest
+_REQ_ADAPTER = TypeAdapter(ChatRequest)
+
+
+def validate_chat_request(data: Any) -> ChatRequest:
+    """Validate client JSON; the common valid case skips Pydantic validation entirely."""
+    if isinstance(data, dict) and isinstance(m := data.get("message"), str) and 1 <= len(m) <= MAX_MESSAGE_LENGTH:
+        return ChatRequest.model_construct(message=m)
+    return _REQ_ADAPTER.validate_python(data)  # raises ValidationError
 
 
 # ---------------------------
 # 2) Utilities
 # ---------------------------
+# Text extractor per result/chunk class (almost always AIMessageChunk when streaming)
+_EXTRACTORS: dict[type, Callable[[Any], str]] = {}
+
+
+def _make_extractor(sample: Any) -> Callable[[Any], str]:
+    # Decided on an instance: Pydantic models (LangChain messages) don't expose fields on the class.
+    if hasattr(sample, "content"):
+        return lambda x: x.content or ""
+    return lambda x: "" if x is None else str(x)
+
+
 def to_text(result: Any) -> str:
     """Convert LLM result / chunk to plain text safely."""
-    if result is None:
-        return ""
-    if hasattr(result, "content"):
-        return result.content or ""
-    return str(result)
+    fn = _EXTRACTORS.get(type(result))
+    if fn is None:
+        fn = _EXTRACTORS.setdefault(type(result), _make_extractor(result))
+    return fn(result)
+
+
+async def send_json_fast(websocket: WebSocket, obj: Any) -> None:
+    """Send JSON via orjson (sent as a binary frame; clients decode it the same way)."""
+    await websocket.send_bytes(orjson.dumps(obj))
+
+
+async def iter_frames(websocket: WebSocket) -> AsyncIterator[str | bytes]:
+    """Yield raw text/binary frames until the client disconnects (like WebSocket.iter_bytes, for either frame type)."""
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            return
+
+        data = message.get("bytes")
+        yield data if data is not None else message["text"]
 
 
 async def safe_close(websocket: WebSocket, code: int) -> None:
@@ -48,134 +158,110 @@ async def safe_close(websocket: WebSocket, code: int) -> None:
         pass
 
 
+# Pydantic v2 error type codes that mean "value exceeds max_length"
+_TOO_LONG_TYPES = frozenset({"string_too_long"})
+
+
+def invalid_payload_frame(template: tuple[bytes, bytes], errors: list[dict]) -> bytes:
+    """Build an INVALID_PAYLOAD frame from a pre-serialized (prefix, suffix) template."""
+    prefix, suffix = template
+    return prefix + orjson.dumps(errors) + suffix
+
+
 def is_message_too_big_error(errors: list[dict]) -> bool:
     """
         Detect Pydantic 'max_length' errors so we can close with 1009 (Message Too Big).
-        Pydantic error structures can vary slightly across versions.
+        Relies on Pydantic v2's stable error type codes.
     """
     for err in errors:
         # Typical fields: {'type': 'string_too_long', 'loc': ('message',), ...}
-        err_type = (err.get("type") or "").lower()
-        msg = (err.get("msg") or "").lower()
-        if "too_long" in err_type or "too long" in msg or "max_length" in msg:
-            # Only treat it as message-too-big if it's related to the 'message' field
-            loc = err.get("loc", ())
-            if isinstance(loc, (list, tuple)) and "message" in loc:
-                return True
+        if err.get("type") in _TOO_LONG_TYPES and err.get("loc", (None,))[0] == "message":
+            return True
     return False
 
 
-async def receive_chat_request(websocket: WebSocket) -> Optional[ChatRequest]:
-    """
-        Receive JSON and validate with Pydantic.
-        - Returns ChatRequest if valid.
-        - Returns None if invalid (also sends error message).
-        - Raises WebSocketDisconnect if client disconnects.
-    """
-    try:
-        data = await websocket.receive_json()
-        return ChatRequest.model_validate(data)  # Pydantic v2
-    
-    except WebSocketDisconnect:
-        raise
-    
-    except ValidationError as ve:
-        errors = ve.errors()
-        # Send a structured error response; keep connection open by default.
-        await websocket.send_json({
-            "type": "error",
-            "code": "INVALID_PAYLOAD",
-            "detail": errors,
-            "example": {"message": "Hi"}
-        })
-        return None
-    
-    except Exception as e:
-        await websocket.send_json({
-            "type": "error",
-            "code": "BAD_REQUEST",
-            "detail": str(e),
-            "example": {"message": "Hi"}
-        })
-        return None
-
-
 # ---------------------------
 # 3) Endpoint 01 (Non-stream)
 # ---------------------------
 @app.websocket("/ws/chat")
 async def ws_chat_non_stream(websocket: WebSocket):
     await websocket.accept()
-    conn_id = str(uuid.uuid4())[:8]
+    conn_id = f"{next(_CONN_COUNTER) & 0xFFFFFFFF:08x}"
     logger.info("WS connected /ws/chat conn_id=%s", conn_id)
 
     close_code = status.WS_1000_NORMAL_CLOSURE
-    lock = asyncio.Lock()
+    sent_help = False  # example payload is sent only with the first INVALID_PAYLOAD error
 
     try:
-        while True:
-            # Receive + validate
+        async for raw in iter_frames(websocket):
+            # Parse + validate
             try:
-                data = await websocket.receive_json()
-                req = ChatRequest.model_validate(data)
+                req = validate_chat_request(orjson.loads(raw))
             
             except ValidationError as ve:
                 errors = ve.errors()
                 # If message too large -> close with 1009
                 if is_message_too_big_error(errors):
-                    await websocket.send_json({
-                        "type": "error",
-                        "code": "MESSAGE_TOO_BIG",
-                        "detail": "Message exceeds max length."
-                    })
+                    await websocket.send_bytes(ERR_TOO_BIG)
                     close_code = status.WS_1009_MESSAGE_TOO_BIG
                     break
 
-                # Otherwise: send error and continue
-                await websocket.send_json({
-                    "type": "error",
-                    "code": "INVALID_PAYLOAD",
-                    "detail": errors,
-                    "example": {"message": "Hi"}
-                })
+                # Otherwise: send error and continue (example only on the first one)
+                await websocket.send_bytes(invalid_payload_frame(ERR_INVALID_TERSE if sent_help else ERR_INVALID_VERBOSE, errors))
+                sent_help = True
                 continue
 
-            async with lock:
-                request_id = str(uuid.uuid4())[:8]
-                try:
-                    result = await asyncio.wait_for(llm.ainvoke(req.message), timeout=60)
+            request_id = f"{next(_REQ_COUNTER) & 0xFFFFFFFF:08x}"
+            try:
+                # Serve from cache if possible (skips the LLM round-trip)
+                lookup = await response_cache.lookup(req.message) if response_cache else None
+                if lookup is not None and lookup.value is not None:
+                    reply_text = lookup.value
+
+                else:
+                    # Timeout on LLM call (avoid hanging); LLM_SEM caps concurrent calls
+                    async with LLM_SEM, asyncio.timeout(60):
+                        result = await llm.ainvoke(req.message)
                     reply_text = to_text(result)
+                    if lookup is not None:
+                        await response_cache.store(lookup, reply_text)
 
-                    await websocket.send_json({
-                        "type": "response",
-                        "request_id": request_id,
-                        "value": reply_text
-                    })
-
-                except asyncio.TimeoutError:
-                    # Tell client; optionally close with 1013 (Try Again Later)
-                    await websocket.send_json({
-                        "type": "error",
-                        "code": "LLM_TIMEOUT",
-                        "request_id": request_id,
-                        "detail": "LLM call exceeded 60 seconds."
-                    })
-                    # If you want to force client reconnect/backoff, uncomment:
-                    close_code = status.WS_1013_TRY_AGAIN_LATER
-                    break
+                await send_json_fast(websocket, {
+                    "type": "response",
+                    "request_id": request_id,
+                    "value": reply_text
+                })
 
-                except Exception as e:
-                    logger.exception("LLM error conn_id=%s request_id=%s", conn_id, request_id)
-                    await websocket.send_json({
-                        "type": "error",
-                        "code": "LLM_ERROR",
-                        "request_id": request_id,
-                        "detail": str(e)
-                    })
-                    close_code = status.WS_1011_INTERNAL_ERROR
-                    break
+            except asyncio.TimeoutError:
+                # Tell client; optionally close with 1013 (Try Again Later)
+                await send_json_fast(websocket, {
+                    "type": "error",
+                    "code": "LLM_TIMEOUT",
+                    "request_id": request_id,
+                    "detail": "LLM call exceeded 60 seconds."
+                })
+                # If you want to force client reconnect/backoff, uncomment:
+                close_code = status.WS_1013_TRY_AGAIN_LATER
+                break
+
+            except Exception as e:
+                logger.exception("LLM error conn_id=%s request_id=%s", conn_id, request_id)
+                await send_json_fast(websocket, {
+                    "type": "error",
+                    "code": "LLM_ERROR",
+                    "request_id": request_id,
+                    "detail": str(e)
+                })
+                close_code = status.WS_1011_INTERNAL_ERROR
+                break
+
+        else:
+            # Loop ended without a break: client disconnected
+            logger.info("WS disconnected /ws/chat conn_id=%s", conn_id)
+            return
 
     except WebSocketDisconnect:
+        # A send after the client has gone
         logger.info("WS disconnected /ws/chat conn_id=%s", conn_id)
         # Client disconnected; no need to close.
         return
@@ -194,102 +280,165 @@ async def ws_chat_non_stream(websocket: WebSocket):
 @app.websocket("/ws/chat2")
 async def ws_chat_stream(websocket: WebSocket):
     await websocket.accept()
-    conn_id = str(uuid.uuid4())[:8]
+    conn_id = f"{next(_CONN_COUNTER) & 0xFFFFFFFF:08x}"
     logger.info("WS connected /ws/chat2 conn_id=%s", conn_id)
 
     close_code = status.WS_1000_NORMAL_CLOSURE
-    lock = asyncio.Lock()
+    sent_help = False  # example payload is sent only with the first INVALID_PAYLOAD error
 
     try:
-        while True:
-            # Receive + validate
+        async for raw in iter_frames(websocket):
+            # Parse + validate
             try:
-                data = await websocket.receive_json()
-                req = ChatRequest.model_validate(data)
+                req = validate_chat_request(orjson.loads(raw))
             
             except ValidationError as ve:
                 errors = ve.errors()
                 if is_message_too_big_error(errors):
-                    await websocket.send_json({
-                        "type": "error",
-                        "status": "MESSAGE_TOO_BIG",
-                        "status_code": status.WS_1009_MESSAGE_TOO_BIG,
-                        "detail": "Message exceeds max length."
-                    })
+                    await websocket.send_bytes(ERR_TOO_BIG_STREAM)
                     close_code = status.WS_1009_MESSAGE_TOO_BIG
                     break
 
-                await websocket.send_json({
-                    "type": "error",
-                    "status": "INVALID_PAYLOAD",
-                    "status_code": status.HTTP_422_UNPROCESSABLE_ENTITY,
-                    "detail": errors,
-                    "example": {"message": "Hi"}
-                })
+                await websocket.send_bytes(invalid_payload_frame(ERR_INVALID_STREAM_TERSE if sent_help else ERR_INVALID_STREAM_VERBOSE, errors))
+                sent_help = True
                 continue
 
-            async with lock:
-                request_id = str(uuid.uuid4())[:8]
-                await websocket.send_json({"type": "start", "request_id": request_id})
-
-                full_text = ""
-
-                async def stream_tokens():
-                    nonlocal full_text
-                    async for chunk in llm.astream(req.message):
-                        token = to_text(chunk)
-                        if not token:
-                            continue
-                        full_text += token
-                        await websocket.send_json({
-                            "type": "chunk",
-                            "request_id": request_id,
-                            "value": token,
-                            "status": "IN_PROGRESS",
-                            "status_code": status.HTTP_200_OK
-                        })
+            # Admission control: no free stream slot -> tell client to back off
+            if STREAM_SEM.locked():
+                await websocket.send_bytes(ERR_BUSY)
+                close_code = status.WS_1013_TRY_AGAIN_LATER
+                break
 
+            # Holds one stream slot and one LLM slot for the whole generation
+            async with STREAM_SEM:
+                # Bounded wait for an LLM slot (shared with /ws/chat): none free in time -> BUSY
                 try:
-                    await asyncio.wait_for(stream_tokens(), timeout=120)
-
-                    await websocket.send_json({
-                        "type": "end",
-                        "request_id": request_id,
-                        "full": full_text,
-                        "status": "COMPLETED",
-                        "status_code": status.HTTP_200_OK
-                    })
-
-                except asyncio.TimeoutError:
-                    await websocket.send_json({
-                        "type": "error",
-                        "code": "STREAM_TIMEOUT",
-                        "request_id": request_id,
-                        "detail": "Streaming exceeded 120 seconds."
-                    })
-                    # Force reconnect/backoff if desired:
+                    async with asyncio.timeout(LLM_SLOT_TIMEOUT):
+                        await LLM_SEM.acquire()
+                except TimeoutError:
+                    await websocket.send_bytes(ERR_BUSY)
                     close_code = status.WS_1013_TRY_AGAIN_LATER
                     break
 
-                except WebSocketDisconnect:
-                    raise
+                try:
+                    request_id = f"{next(_REQ_COUNTER) & 0xFFFFFFFF:08x}"
+                    await send_json_fast(websocket, {"type": "start", "request_id": request_id})
+
+                    parts: list[str] = []
+                    buf: list[str] = []
+                    buf_len = 0
+                    loop = asyncio.get_running_loop()
+                    last_flush = loop.time()
+
+                    # LLM decode runs as its own task, feeding a bounded queue, so a slow
+                    # client doesn't stall token generation (up to STREAM_QUEUE_SIZE tokens).
+                    tokens: asyncio.Queue[Optional[str]] = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+
+                    async def produce() -> None:
+                        try:
+                            async for chunk in llm.astream(req.message):
+                                token = to_text(chunk)
+                                if token:  # some providers send empty/None chunks
+                                    await tokens.put(token)
+                        except Exception:
+                            await tokens.put(None)  # wake the consumer; error re-raised via `await producer`
+                            raise
+                        await tokens.put(None)
 
-                except Exception as e:
-                    logger.exception("Streaming error conn_id=%s request_id=%s", conn_id, request_id)
                     try:
-                        await websocket.send_json({
+                        async with asyncio.timeout(120):
+                            producer = asyncio.create_task(produce())
+                            try:
+                                while True:
+                                    # While tokens are buffered, wait for the next one only until the flush deadline
+                                    try:
+                                        async with asyncio.timeout_at(last_flush + STREAM_FLUSH_INTERVAL if buf else None):
+                                            token = await tokens.get()
+                                    except TimeoutError:
+                                        token = ""  # deadline reached: flush below
+                                    if token is None:
+                                        break
+
+                                    if token:
+                                        parts.append(token)
+                                        buf.append(token)
+                                        buf_len += len(token)
+
+                                    # First token goes out immediately (time to first token)
+                                    if buf and (len(parts) == 1 or buf_len >= STREAM_FLUSH_CHARS or loop.time() - last_flush >= STREAM_FLUSH_INTERVAL):
+                                        await send_json_fast(websocket, {
+                                            "type": "chunk",
+                                            "request_id": request_id,
+                                            "value": "".join(buf),
+                                            "status": "IN_PROGRESS",
+                                            "status_code": status.HTTP_200_OK
+                                        })
+                                        buf.clear()
+                                        buf_len = 0
+                                        last_flush = loop.time()
+
+                                await producer  # re-raises LLM errors
+                            finally:
+                                # Wait for the producer to unwind (closes the astream/HTTP stream)
+                                # before the semaphores are released.
+                                producer.cancel()
+                                await asyncio.gather(producer, return_exceptions=True)
+
+                            if buf:
+                                await send_json_fast(websocket, {
+                                    "type": "chunk",
+                                    "request_id": request_id,
+                                    "value": "".join(buf),
+                                    "status": "IN_PROGRESS",
+                                    "status_code": status.HTTP_200_OK
+                                })
+
+                        await send_json_fast(websocket, {
+                            "type": "end",
+                            "request_id": request_id,
+                            "full": "".join(parts),
+                            "status": "COMPLETED",
+                            "status_code": status.HTTP_200_OK
+                        })
+
+                    except asyncio.TimeoutError:
+                        await send_json_fast(websocket, {
                             "type": "error",
-                            "code": "STREAM_ERROR",
+                            "code": "STREAM_TIMEOUT",
                             "request_id": request_id,
-                            "detail": str(e)
+                            "detail": "Streaming exceeded 120 seconds."
                         })
-                    except Exception:
-                        pass
+                        # Force reconnect/backoff if desired:
+                        close_code = status.WS_1013_TRY_AGAIN_LATER
+                        break
+
+                    except WebSocketDisconnect:
+                        raise
+
+                    except Exception as e:
+                        logger.exception("Streaming error conn_id=%s request_id=%s", conn_id, request_id)
+                        try:
+                            await send_json_fast(websocket, {
+                                "type": "error",
+                                "code": "STREAM_ERROR",
+                                "request_id": request_id,
+                                "detail": str(e)
+                            })
+                        except Exception:
+                            pass
                     
-                    close_code = status.WS_1011_INTERNAL_ERROR
-                    break
+                        close_code = status.WS_1011_INTERNAL_ERROR
+                        break
+                finally:
+                    LLM_SEM.release()
+
+        else:
+            # Loop ended without a break: client disconnected
+            logger.info("WS disconnected /ws/chat2 conn_id=%s", conn_id)
+            return
 
     except WebSocketDisconnect:
+        # A send after the client has gone
         logger.info("WS disconnected /ws/chat2 conn_id=%s", conn_id)
         return
 
@@ -0,0 +1,298 @@
+import asyncio
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, NamedTuple, Optional
+
+from log import logger
+
+try:
+    import fcntl  # POSIX only (file lock for the persisted cache)
+except ImportError:
+    fcntl = None
+
+
+# Cache settings (from Environment Variables):
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_SIMILARITY_THRESHOLD = float(os.getenv("CACHE_SIMILARITY_THRESHOLD", "0.95"))
+CACHE_INDEX_PATH = os.getenv("CACHE_INDEX_PATH")  # unset -> in-memory only
+CACHE_PERSIST_EVERY = int(os.getenv("CACHE_PERSIST_EVERY", "100"))
+CACHE_HNSW_M = 32
+CACHE_HNSW_EF = 64
+
+
+def cache_key(prompt: str) -> bytes:
+    """SHA-256 of the normalized prompt (used by the exact-match tier)."""
+    return hashlib.sha256(prompt.strip().lower().encode()).digest()
+
+
+# ---------------------------
+# 1) Exact-match tier
+# ---------------------------
+class ExactCache:
+    """LRU dict of prompt hash -> reply text."""
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._data: OrderedDict[bytes, str] = OrderedDict()
+
+    def get(self, key: bytes) -> Optional[str]:
+        value = self._data.get(key)
+        if value is not None:
+            self._data.move_to_end(key)
+        return value
+
+    def put(self, key: bytes, value: str) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+
+# ---------------------------
+# 2) Semantic tier (FAISS HNSW)
+# ---------------------------
+class SemanticCache:
+    """
+        Embedding-similarity lookup over previously answered prompts.
+        Vectors are L2-normalized, so inner product == cosine similarity.
+        HNSW keeps search ~log(N); all index work runs on one background thread
+        (FAISS indexes are not safe for concurrent add + search).
+        HNSW can't delete entries, so once max_entries are stored new prompts are not added.
+        A vector of a different dimension (embedding model changed) resets the cache.
+        Disk writes run on a separate I/O thread: replies are appended to <path>.jsonl
+        one line per insert, and the index is snapshotted every persist_every inserts.
+        Only the process holding <path>.lock persists (line i of the .jsonl must match vector i).
+    """
+
+    def __init__(
+        self,
+        threshold: float = CACHE_SIMILARITY_THRESHOLD,
+        max_entries: int = CACHE_MAX_ENTRIES,
+        index_path: Optional[str] = CACHE_INDEX_PATH,
+        persist_every: int = CACHE_PERSIST_EVERY,
+    ):
+        # Imported lazily: only needed when the cache is enabled.
+        import faiss
+        import numpy as np
+
+        self._faiss = faiss
+        self._np = np
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.index_path = index_path
+        self.persist_every = persist_every
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="semantic-cache")
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="semantic-cache-io")
+        self._index = None  # created on first add (dimension known then)
+        self._values: list[str] = []
+        self._unsaved = 0
+        self._full_logged = False
+        self._lock_file = None
+
+        # One writer per file pair: other workers keep their semantic cache in memory only.
+        if index_path and not self._lock_files():
+            logger.warning("Semantic cache files at %s are in use by another process; this one is in-memory only", index_path)
+            self.index_path = index_path = None
+
+        if index_path and not (os.path.exists(index_path) and self._load()):
+            self._reset_files()
+
+    def to_vector(self, embedding: list[float]) -> Any:
+        vec = self._np.asarray([embedding], dtype="float32")
+        self._faiss.normalize_L2(vec)
+        return vec
+
+    async def search(self, vec: Any) -> Optional[str]:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._search, vec)
+
+    async def add(self, vec: Any, value: str) -> None:
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._add, vec, value)
+
+    def _new_index(self, dim: int) -> Any:
+        index = self._faiss.IndexHNSWFlat(dim, CACHE_HNSW_M, self._faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = CACHE_HNSW_EF
+        index.hnsw.efSearch = CACHE_HNSW_EF
+        return index
+
+    def _search(self, vec: Any) -> Optional[str]:
+        if self._index is not None and vec.shape[1] != self._index.d:
+            self._reset(vec.shape[1])
+        if self._index is None or self._index.ntotal == 0:
+            return None
+
+        scores, ids = self._index.search(vec, 1)
+        if ids[0][0] >= 0 and scores[0][0] >= self.threshold:
+            return self._values[ids[0][0]]
+        return None
+
+    def _add(self, vec: Any, value: str) -> None:
+        if len(self._values) >= self.max_entries:
+            if not self._full_logged:
+                logger.warning("Semantic cache is full (%s entries); new prompts are not cached", self.max_entries)
+                self._full_logged = True
+            return
+
+        if self._index is not None and vec.shape[1] != self._index.d:
+            self._reset(vec.shape[1])
+        if self._index is None:
+            self._index = self._new_index(vec.shape[1])
+        self._index.add(vec)
+        self._values.append(value)
+
+        if self.index_path:
+            self._io.submit(self._append_value, value)
+            self._unsaved += 1
+            if self._unsaved >= self.persist_every:
+                # In-memory snapshot here (memcpy-fast); the disk write happens on the I/O thread.
+                self._io.submit(self._write_index, self._faiss.serialize_index(self._index))
+                self._unsaved = 0
+
+    def _reset(self, dim: int) -> None:
+        """Drop the index (e.g. the embedding model changed dimension); an old-dimension index can't be searched."""
+        logger.warning("Semantic cache dimension changed (%s -> %s); starting empty", self._index.d, dim)
+        self._index = None
+        self._values = []
+        self._unsaved = 0
+        self._full_logged = False
+        if self.index_path:
+            self._io.submit(self._reset_files)  # queued after any pending appends
+
+    def _append_value(self, value: str) -> None:
+        """Append one reply to <path>.jsonl (line i -> index position i)."""
+        try:
+            with open(self.index_path + ".jsonl", "a", encoding="utf-8") as f:
+                f.write(json.dumps(value) + "\n")
+        except Exception:
+            logger.exception("Could not persist semantic cache reply to %s.jsonl", self.index_path)
+
+    def _write_index(self, data: Any) -> None:
+        """Atomically replace the index file with a serialized snapshot."""
+        tmp = self.index_path + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                data.tofile(f)
+            os.replace(tmp, self.index_path)
+        except Exception:
+            logger.exception("Could not persist semantic cache to %s", self.index_path)
+
+    def _reset_files(self) -> None:
+        """Start the on-disk cache empty (stale replies would misalign with new inserts)."""
+        for path in (self.index_path, self.index_path + ".jsonl"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _lock_files(self) -> bool:
+        """Hold an exclusive lock on <path>.lock for the process lifetime (no-op without fcntl)."""
+        if fcntl is None:
+            return True
+
+        try:
+            self._lock_file = open(self.index_path + ".lock", "w")
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
+            return False
+        return True
+
+    def _load(self) -> bool:
+        try:
+            index = self._faiss.read_index(self.index_path)
+            with open(self.index_path + ".jsonl", encoding="utf-8") as f:
+                values = [json.loads(line) for line in f]
+        except Exception:
+            logger.exception("Could not load semantic cache from %s (starting empty)", self.index_path)
+            return False
+
+        # Replies are appended on every insert, the index only every persist_every inserts:
+        # extra trailing replies (newer than the snapshot) are dropped.
+        if len(values) < index.ntotal:
+            logger.warning("Semantic cache at %s is inconsistent (starting empty)", self.index_path)
+            return False
+
+        if len(values) > index.ntotal:
+            values = values[:index.ntotal]
+            try:
+                with open(self.index_path + ".jsonl", "w", encoding="utf-8") as f:
+                    f.writelines(json.dumps(v) + "\n" for v in values)
+            except Exception:
+                logger.exception("Could not rewrite %s.jsonl", self.index_path)
+                return False
+
+        index.hnsw.efSearch = CACHE_HNSW_EF
+        self._index, self._values = index, values
+        return True
+
+
+# ---------------------------
+# 3) Two-tier response cache
+# ---------------------------
+class CacheLookup(NamedTuple):
+    key: bytes
+    vector: Any            # None if the prompt could not be embedded
+    value: Optional[str]   # cached reply text (None on miss)
+
+
+class ResponseCache:
+    """Exact-match cache first, then semantic cache, in front of the LLM call."""
+
+    def __init__(self, embeddings: Any):
+        self.embeddings = embeddings
+        self.exact = ExactCache()
+        self.semantic = SemanticCache()
+
+    async def lookup(self, prompt: str) -> CacheLookup:
+        key = cache_key(prompt)
+        value = self.exact.get(key)
+        if value is not None:
+            return CacheLookup(key, None, value)
+
+        try:
+            vec = self.semantic.to_vector(await self.embeddings.aembed_query(prompt))
+        except Exception:
+            # Embedding failure must not break the chat; fall back to exact-match only.
+            logger.exception("Embedding error (semantic cache skipped)")
+            return CacheLookup(key, None, None)
+
+        try:
+            value = await self.semantic.search(vec)
+        except Exception:
+            # Same for a cache fault: fall back to the LLM.
+            logger.exception("Semantic cache search failed")
+            return CacheLookup(key, None, None)
+
+        if value is not None:
+            self.exact.put(key, value)
+        return CacheLookup(key, vec, value)
+
+    async def warmup(self) -> None:
+        """Embed a dummy prompt (opens the embeddings connection at startup)."""
+        await self.embeddings.aembed_query("ping")
+
+    async def store(self, lookup: CacheLookup, value: str) -> None:
+        self.exact.put(lookup.key, value)
+        if lookup.vector is not None:
+            try:
+                await self.semantic.add(lookup.vector, value)
+            except Exception:
+                # A cache write failure must not fail the reply.
+                logger.exception("Semantic cache add failed")
+
+
+def build_response_cache() -> Optional[ResponseCache]:
+    """Returns the shared ResponseCache, or None if CACHE_ENABLED is off."""
+    if not CACHE_ENABLED:
+        return None
+
+    from llm import embeddings
+    return ResponseCache(embeddings)
+
+
+response_cache = build_response_cache()
@@ -1,5 +1,6 @@
-from langchain_openai import AzureChatOpenAI
+from langchain_openai import AzureChatOpenAI, AzureOpenAIEmbeddings
 from dotenv import load_dotenv
+import httpx
 import os
 
 # Load the Environment Variables:
@@ -8,12 +9,38 @@ load_dotenv()
 AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
 AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
 AZURE_API_VERSION = os.getenv("AZURE_API_VERSION")
+AZURE_EMBEDDING_DEPLOYMENT = os.getenv("AZURE_EMBEDDING_DEPLOYMENT", "text-embedding-3-small")
+LLM_WARMUP = os.getenv("LLM_WARMUP", "true").lower() in ("1", "true", "yes")
 
 os.environ["AZURE_OPENAI_ENDPOINT"] = AZURE_OPENAI_ENDPOINT
 
 
+# One shared async HTTP client (HTTP/2, pooled keep-alive connections) for all Azure calls.
+# Closed by the apps' FastAPI lifespan.
+http_async_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=256, max_keepalive_connections=128),
+    timeout=httpx.Timeout(60.0, connect=5.0)
+)
+
+
 llm = AzureChatOpenAI(
     api_key=AZURE_OPENAI_API_KEY,
     api_version=AZURE_API_VERSION,
-    azure_deployment="gpt-4o"
-)
\ No newline at end of file
+    azure_deployment="gpt-4o",
+    http_async_client=http_async_client
+)
+
+
+# Embeddings model (used by the semantic response cache):
+embeddings = AzureOpenAIEmbeddings(
+    api_key=AZURE_OPENAI_API_KEY,
+    api_version=AZURE_API_VERSION,
+    azure_deployment=AZURE_EMBEDDING_DEPLOYMENT,
+    http_async_client=http_async_client
+)
+
+
+async def warmup_llm() -> None:
+    """One-token call at startup so the connection/TLS setup isn't paid by the first user message."""
+    await llm.bind(max_tokens=1).ainvoke("ping")
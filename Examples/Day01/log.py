@@ -0,0 +1,31 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+
+
+# Shared "ws-chat" logger (configured once per process, however many apps import it).
+logger = logging.getLogger("ws-chat")
+
+# Level: LOG_LEVEL if set, otherwise inherited from the root logger (WARNING by default).
+if os.getenv("LOG_LEVEL"):
+    logger.setLevel(os.environ["LOG_LEVEL"].upper())
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that enqueues the raw record; formatting happens on the listener thread."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The default prepare() formats the message (and traceback) in the calling thread,
+        # i.e. on the event loop. Same-process queue, so the record can go as-is.
+        return record
+
+
+# Log off the event loop: the handler only enqueues records, a background thread formats + writes them.
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+logger.addHandler(_DeferredQueueHandler(_log_queue))
+logger.propagate = False
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+atexit.register(_log_listener.stop)